@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 import numpy as np
 
 from .. import getisord
@@ -10,6 +11,15 @@ W = DistanceBand(POINTS, threshold=15)
 Y = np.array([2, 3, 3.2, 5, 8, 7])
 
 PANDAS_EXTINCT = pandas is None
+CUPY_EXTINCT = not getisord.HAS_CUPY
+# the numba and numpy samplers consume the random stream differently, so
+# seeded pseudo p-values depend on which one is active
+P_SIM = 0.10300000000000001 if getisord.HAS_JIT else 0.114
+# row-standardized G* pseudo p-values, keyed by HAS_JIT; observation 4 has
+# all but one other observation as neighbors, so many simulated Gs tie with
+# the observed one and any rounding drift shows up there
+P_SIM_R_STAR = {True: [0.103, 0.402, 0.184, 0.293, 0.196, 0.207],
+                False: [0.114, 0.406, 0.208, 0.308, 0.212, 0.209]}
 
 class G_Tester(unittest.TestCase):
 
@@ -46,22 +56,92 @@ class G_Local_Tester(unittest.TestCase):
     def test_G_Local_Binary(self):
         lg = getisord.G_Local(self.y, self.w, transform='B')
         self.assertAlmostEqual(lg.Zs[0], -1.0136729, places=7)
-        self.assertAlmostEqual(lg.p_sim[0], 0.10100000000000001, places=7)
+        self.assertAlmostEqual(lg.p_sim[0], P_SIM, places=7)
 
     def test_G_Local_Row_Standardized(self):
         lg = getisord.G_Local(self.y, self.w, transform='R')
         self.assertAlmostEqual(lg.Zs[0], -0.62074534, places=7)
-        self.assertAlmostEqual(lg.p_sim[0], 0.10100000000000001, places=7)
+        self.assertAlmostEqual(lg.p_sim[0], P_SIM, places=7)
 
     def test_G_star_Local_Binary(self):
         lg = getisord.G_Local(self.y, self.w, transform='B', star=True)
         self.assertAlmostEqual(lg.Zs[0], -1.39727626, places=8)
-        self.assertAlmostEqual(lg.p_sim[0], 0.10100000000000001, places=7)
+        self.assertAlmostEqual(lg.p_sim[0], P_SIM, places=7)
 
     def test_G_star_Row_Standardized(self):
         lg = getisord.G_Local(self.y, self.w, transform='R', star=True)
         self.assertAlmostEqual(lg.Zs[0], -0.62488094, places=8)
-        self.assertAlmostEqual(lg.p_sim[0], 0.10100000000000001, places=7)
+        self.assertAlmostEqual(lg.p_sim[0], P_SIM, places=7)
+        np.testing.assert_allclose(lg.p_sim, P_SIM_R_STAR[getisord.HAS_JIT])
+        if getisord.HAS_JIT:
+            np.random.seed(10)
+            with mock.patch.object(getisord, 'HAS_JIT', False):
+                lg = getisord.G_Local(self.y, self.w, transform='R', star=True)
+            np.testing.assert_allclose(lg.p_sim, P_SIM_R_STAR[False])
+
+    def test_G_Local_int(self):
+        y = np.array([2, 3, 3, 5, 8, 7])
+        lg = getisord.G_Local(y, self.w, transform='R')
+        self.assertAlmostEqual(lg.Zs[0], -0.58834841, places=8)
+        lg_star = getisord.G_Local(y, self.w, transform='R', star=True)
+        self.assertAlmostEqual(lg_star.Zs[0], -0.60302269, places=8)
+
+    def test_G_Local_float32(self):
+        lg = getisord.G_Local(self.y, self.w, transform='B', dtype=np.float32)
+        self.assertEqual(lg.rGs.dtype, np.float32)
+        self.assertAlmostEqual(lg.Zs[0], -1.0136729, places=7)
+        self.assertAlmostEqual(lg.p_sim[0], P_SIM, places=7)
+
+    def test_G_Local_n_jobs(self):
+        self.assertRaises(ValueError, getisord.G_Local, self.y, self.w,
+                          n_jobs=0)
+        # n_jobs only applies to the numpy sampler
+        with mock.patch.object(getisord, 'HAS_JIT', False):
+            lg = getisord.G_Local(self.y, self.w, transform='B', n_jobs=2)
+        self.assertEqual(lg.rGs.shape, (6, getisord.PERMUTATIONS))
+        # each worker draws its chunk from its own seeded stream, so the
+        # pool reproduces the same chunks computed in process
+        np.random.seed(10)
+        seeds = np.random.randint(0, 2 ** 31 - 1, size=2)
+        den = np.ones(lg.n)
+        chunks = [getisord._crand_spmm(np.random.RandomState(s), lg.y,
+                                       lg._WB, den, False, lg.y_sum, k,
+                                       np.float64)
+                  for s, k in zip(seeds, (500, 499))]
+        np.testing.assert_allclose(lg.rGs, np.hstack(chunks))
+
+    def test_crand_spmm_streams(self):
+        # draws from independent streams, as used by the n_jobs workers,
+        # come from the same distribution
+        w = self.w
+        w.transform = 'B'
+        den = np.ones(w.n)
+        a, b = [getisord._crand_spmm(np.random.RandomState(s), self.y,
+                                     w.sparse, den, False, self.y.sum(),
+                                     getisord.PERMUTATIONS, np.float64)
+                for s in (1, 2)]
+        se = np.sqrt((a.var(1) + b.var(1)) / getisord.PERMUTATIONS)
+        diff = np.abs(a.mean(1) - b.mean(1))
+        self.assertTrue((diff < 4 * se).all())
+
+    def test_G_Local_backend(self):
+        self.assertRaises(ValueError, getisord.G_Local, self.y, self.w,
+                          backend='gpu')
+
+    @unittest.skipIf(CUPY_EXTINCT, 'missing cupy')
+    def test_G_Local_cupy(self):
+        lg = getisord.G_Local(self.y, self.w, transform='B', backend='cupy')
+        self.assertIsInstance(lg.rGs, np.ndarray)
+        self.assertEqual(lg.rGs.shape, (6, getisord.PERMUTATIONS))
+        self.assertAlmostEqual(lg.Zs[0], -1.0136729, places=7)
+        self.assertTrue(((lg.p_sim > 0) & (lg.p_sim <= 1)).all())
+        # the GPU draws match the numpy sampler in distribution
+        ref = getisord._crand_spmm(np.random.RandomState(1), lg.y, lg._WB,
+                                   np.ones(lg.n), False, lg.y_sum,
+                                   getisord.PERMUTATIONS, np.float64)
+        se = np.sqrt((lg.rGs.var(1) + ref.var(1)) / getisord.PERMUTATIONS)
+        diff = np.abs(lg.rGs.mean(1) - ref.mean(1))
+        self.assertTrue((diff < 4 * se).all())
 
     @unittest.skipIf(PANDAS_EXTINCT, 'missing pandas')
     def test_by_col(self):
@@ -79,6 +159,7 @@ test_classes = [G_Tester, G_Local_Tester]
 for i in test_classes:
     a = unittest.TestLoader().loadTestsFromTestCase(i)
     suite.addTest(a)
+del i  # keep pytest from collecting the loop variable as a test class
 
 if __name__ == '__main__':
     runner = unittest.TextTestRunner()